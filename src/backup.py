@@ -1,13 +1,111 @@
+import base64
 import json
 import os
+import posixpath
+import re
+import shlex
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    # Optional streaming JSON parser, only needed when gh is too old for --jq
+    import ijson
+    _JSON_ERRORS = (ValueError, KeyError, TypeError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    _JSON_ERRORS = (ValueError, KeyError, TypeError)
+
+try:
+    # Optional fast JSON parser for the same fallback when ijson is not installed,
+    # orjson.JSONDecodeError is a ValueError
+    import orjson
+except ImportError:
+    orjson = None
+
+# Repositories owned by the signed in user, gh --paginate feeds $endCursor from pageInfo
+_REPOS_QUERY = """
+query($endCursor: String) {
+  viewer {
+    repositories(first: 100, after: $endCursor, ownerAffiliations: OWNER) {
+      nodes { url }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+# Where the clone URLs sit in each page of the GraphQL response
+_URLS_JQ = ".data.viewer.repositories.nodes[].url"
+_URLS_PREFIX = "data.viewer.repositories.nodes.item.url"
+# Gap between two page documents in gh --paginate output
+_PAGE_BOUNDARY = re.compile(rb"(?<=})\s*(?={)")
+
+# Fixed parts of the git command lines, shared by every worker
+_PROBE_ARGS = ("rev-parse", "--git-dir")
+_CLONE_PREFIX = ("git", "clone")
+_MIRROR_CLONE_PREFIX = ("git", "clone", "--bare")
+# Tags are listed too, so --prune also drops tags deleted on GitHub
+_MIRROR_REFSPEC = ("origin", "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")
+_PARTIAL_FILTER = ("--filter=blob:none",)
+# git writes paths and ref names as UTF-8 whatever the locale (cp1252 on Windows), so its
+# output is decoded as UTF-8, and a stray byte becomes U+FFFD instead of an exception
+_GIT_TEXT = dict(text=True, encoding="utf-8", errors="replace")
+# Bare repository holding every repository as a remote in combined mode
+_COMBINED_DIR = ".superbackup"
+
+# Configuration every git command runs with: protocol v2 lets the server skip advertising
+# refs we never ask for, and fetch.parallel=0 lets a fetch use as many jobs as it sees fit
+_GIT_CONFIG = (("protocol.version", "2"), ("fetch.parallel", "0"))
+# Extra request header for github.com only, carries the gh token to git
+_AUTH_HEADER_KEY = "http.https://github.com/.extraHeader"
+# ssh for SSH remotes: the first connection becomes a master that later git processes
+# reuse, and it lingers for a while so the next repositories skip the handshake too.
+# The sockets live in the user's own ~/.ssh (0700) rather than the shared temp folder,
+# where another user could create the predictable name first
+_SSH_CONTROL_DIR = os.path.join(os.path.expanduser("~"), ".ssh")
+_SSH_COMMAND = "ssh -o ControlMaster=auto -o ControlPersist=10m -o " + shlex.quote(
+    # ssh expands % tokens in ControlPath, so a literal % in the home path is doubled
+    "ControlPath=" + os.path.join(_SSH_CONTROL_DIR.replace("%", "%%"), "github-backup-%C")
+)
 
 
 class GithubBackup:
-    def __init__(self, path, log_callback, progress_callback=None):
+    def __init__(self, path, log_callback, progress_callback=None, max_workers=8, mirror=False, partial=False,
+                 combined=False, cache_ttl=None, popen=subprocess.Popen):
         self.__path = path
         self.log = log_callback
         self.progress = progress_callback
+        # Number of git processes allowed to run at the same time
+        self.max_workers = max_workers
+        # Keep bare "<name>.git" copies of every branch instead of checked out working trees
+        self.mirror = mirror
+        # Mirror mode only: skip file contents (blobs), they stay fetchable from GitHub on demand
+        self.partial = partial
+        # Fetch everything into a single bare repository with one remote per repository instead
+        self.combined = combined
+        # How long gh may answer a repeated listing from its local cache (e.g. "5m"), None always
+        # asks GitHub. The cache is not revalidated, so a repository created within that time is
+        # left out of the backup, only callers repeating backups back to back should opt in
+        self.cache_ttl = cache_ttl
+        # Starts every gh and git process, tests hand in a stand-in here
+        self.popen = popen
+        # Environment every backup starts from, built once
+        self._base_env = _git_config_env(os.environ, _GIT_CONFIG)
+        # Environment for every git command of the current backup, shared by all workers
+        self._env = self._base_env
+        # Full path of git, needed for the POSIX posix_spawn fast path (see _spawn_git)
+        self._git = shutil.which("git")
+        # Last progress value reported, so repeats and steps backwards are not signalled
+        self._last_percent = -1
+
+    # Report progress only when it moves forward, with many repositories several
+    # in a row land on the same percentage
+    def _report(self, percent):
+        if percent <= self._last_percent:
+            return
+        self._last_percent = percent
+        if self.progress:
+            self.progress(percent)
 
     def set_path(self, path):
         self.__path = path
@@ -19,69 +117,357 @@ class GithubBackup:
     def fetch_repos(self):
         self.log("Fetching repositories...\n")
         # Show 0% at start of fetch
-        if self.progress:
-            self.progress(0)
+        self._last_percent = -1
+        self._report(0)
 
-        # Use gh to list repositories, format it to output clone URLs
-        result = subprocess.run(
-            ["gh", "repo", "list", "--json", "url", "--limit", "1000"],
-            capture_output=True,
-            text=True,
-        )
-
-        if result.returncode != 0:
-            self.log(f"Error fetching repositories: {result.stderr}")
-            if self.progress:
-                self.progress(100)
+        try:
+            returncode, urls, stderr = self._list_urls_jq()
+            if returncode != 0 and "unknown flag" in stderr:
+                # Older gh releases lack --jq or --cache, so parse the JSON pages here instead
+                try:
+                    returncode, urls, stderr = self._list_urls_json()
+                except _JSON_ERRORS as e:
+                    self.log(f"Failed to parse JSON: {e}\n")
+                    self._report(100)
+                    return []
+        except OSError as e:
+            # No gh on PATH, or it cannot be started
+            self.log(f"Error running the GitHub CLI (gh): {e}\n")
+            self._report(100)
             return []
 
-        try:
-            # Parse the JSON output
-            repos = json.loads(result.stdout)
-            # Extract the sshUrl from each repository
-            urls = [repo["url"] for repo in repos]
-            self.log(f"Found {len(urls)} repositories.\n")
-            # Show 10% when fetch done
-            if self.progress:
-                self.progress(10)
-            return urls
-        except json.JSONDecodeError as e:
-            self.log(f"Failed to parse JSON: {e}\n")
-            if self.progress:
-                self.progress(100)
+        if returncode != 0:
+            self.log(f"Error fetching repositories: {stderr}")
+            self._report(100)
             return []
 
+        self.log(f"Found {len(urls)} repositories.\n")
+        # Show 10% when fetch done
+        self._report(10)
+        return urls
+
+    # List clone URLs using gh's --jq filter, which prints one URL per line
+    def _list_urls_jq(self):
+        # One gh process walks every page over a single connection
+        args = ["gh", "api", "graphql", "--paginate", "-f", f"query={_REPOS_QUERY}", "--jq", _URLS_JQ]
+        if self.cache_ttl:
+            args += ["--cache", self.cache_ttl]
+
+        with self.popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+            # No JSON is parsed on this side, and URLs hold no whitespace, so the raw bytes
+            # are split once instead of going line by line through a text wrapper
+            urls = proc.stdout.read().decode().split()
+            stderr = proc.stderr.read()
+        return proc.returncode, urls, stderr.decode(errors="replace")
+
+    # List clone URLs by parsing gh's JSON pages, raises if gh succeeded but the JSON is malformed
+    def _list_urls_json(self):
+        error = None
+        with self.popen(
+            ["gh", "api", "graphql", "--paginate", "-f", f"query={_REPOS_QUERY}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        ) as proc:
+            try:
+                if ijson:
+                    # Pull each URL out as it is tokenized, the pages are never built as objects
+                    urls = list(ijson.items(proc.stdout, _URLS_PREFIX, multiple_values=True))
+                else:
+                    urls = _parse_pages(proc.stdout.read())
+            except _JSON_ERRORS as e:
+                # A failing gh prints nothing to parse, so only its own error is reported then
+                urls, error = [], e
+            stderr = proc.stderr.read().decode(errors="replace")
+
+        if error and proc.returncode == 0:
+            raise error
+        return proc.returncode, urls, stderr
+
+    # Clone or update a single repository, runs inside a worker thread
+    def _sync_one(self, repo_url, probe_env, existing):
+        repo_name = _repo_name(repo_url)
+        repo_path = os.path.join(self.__path, repo_name)
+        if self.mirror:
+            repo_path += ".git"
+
+        is_repo = False
+        if os.path.basename(repo_path) in existing:
+            # Let git decide whether the folder holds a repository, a plain folder is not enough
+            probe = self._spawn_git(
+                ["git", "-C", repo_path, *_PROBE_ARGS],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                env=probe_env,
+            )
+            is_repo = probe.wait() == 0
+
+        if is_repo and self._is_up_to_date(repo_url, repo_path):
+            return repo_name, "Unchanged"
+
+        # Partial clones must keep asking for the same filter when fetching
+        blob_filter = _PARTIAL_FILTER if self.mirror and self.partial else ()
+        if is_repo:
+            action, done = "update", "Updated"
+            if self.mirror:
+                # Bare clones have no remote-tracking refs, fetch branches straight into refs/heads
+                args = ["git", "-C", repo_path, "fetch", "--prune", *blob_filter, *_MIRROR_REFSPEC]
+            else:
+                # Pull the latest changes into the existing clone
+                args = ["git", "-C", repo_path, "pull"]
+        else:
+            action, done = "clone", "Cloned"
+            prefix = _MIRROR_CLONE_PREFIX if self.mirror else _CLONE_PREFIX
+            args = [*prefix, *blob_filter, repo_url, repo_path]
+
+        if self._run_git(args, repo_name) != 0:
+            return repo_name, f"Failed to {action}"
+        return repo_name, done
+
+    # Whether the local copy already has every branch and tag GitHub has. One small ref
+    # listing is much cheaper than the negotiation a fetch or pull goes through
+    def _is_up_to_date(self, repo_url, repo_path):
+        returncode, lines = self._git_lines(["git", "ls-remote", "--heads", "--tags", repo_url])
+        if returncode != 0:
+            return False
+        remote = {}
+        for line in lines:
+            sha, _, ref = line.partition("\t")
+            # Skip the peeled "^{}" entries of annotated tags, refs/tags/<tag> itself is compared
+            if not ref.endswith("^{}"):
+                remote[ref] = sha
+
+        returncode, lines = self._git_lines(
+            ["git", "-C", repo_path, "for-each-ref", "--format=%(HEAD) %(objectname) %(refname) %(upstream)"]
+        )
+        if returncode != 0:
+            return False
+        local = {}
+        current = None
+        for line in lines:
+            # The HEAD marker is "*" or a space, followed by the separator
+            sha, ref, upstream = line[2:].split(" ", 2)
+            local[ref] = sha
+            if line[0] == "*":
+                current = (sha, upstream)
+
+        if self.mirror:
+            # A mirror fetch prunes refs deleted on GitHub, so it is only skipped when the
+            # branches and tags match exactly, with no copies of deleted ones left over
+            return {ref: sha for ref, sha in local.items() if ref.startswith(("refs/heads/", "refs/tags/"))} == remote
+        # pull only moves the checked out branch, it must already match its upstream
+        if current is None or local.get(current[1]) != current[0]:
+            return False
+        # A working tree clone follows GitHub's branches as origin/<branch>. Tags are left out:
+        # pull only brings along tags reachable from the branches, so one on an unreachable
+        # commit would never arrive and the clone would never count as up to date
+        for ref, sha in remote.items():
+            if ref.startswith("refs/heads/"):
+                if local.get("refs/remotes/origin/" + ref.removeprefix("refs/heads/")) != sha:
+                    return False
+        return True
+
+    # Run a git command quietly, returns its exit code and output lines
+    def _git_lines(self, args):
+        with self._spawn_git(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, **_GIT_TEXT) as proc:
+            lines = proc.stdout.read().splitlines()
+        return proc.returncode, lines
+
+    # Run a git command, streaming its output to the log as it is written, returns its exit code
+    def _run_git(self, args, prefix, on_line=None):
+        # stderr is folded into stdout so one pipe carries everything, in order
+        with self._spawn_git(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, **_GIT_TEXT) as proc:
+            self._pump(proc, prefix, on_line)
+        return proc.returncode
+
+    # Start a git process. Every git command goes through here so that, on POSIX, CPython
+    # can use posix_spawn (vfork on glibc) instead of fork+exec, which would copy the page
+    # tables of the whole GUI process for each of the hundreds of git runs. Windows has no
+    # such fast path and starts git the plain way. On POSIX it is only taken while all of
+    # these hold, keep them when editing:
+    #   - executable is a path with a directory part (shutil.which), not a bare "git"
+    #   - close_fds=False, safe since Python opens descriptors non-inheritable (PEP 446).
+    #     POSIX only: on Windows the parallel git children would inherit each other's
+    #     pipe handles, and a pipe would not reach EOF until some unrelated git exited
+    #   - no preexec_fn, pass_fds, start_new_session, process_group, user or group changes
+    #   - no cwd, use "git -C <path>" instead
+    #   - stdin/stdout/stderr inherited, DEVNULL, PIPE or STDOUT, never descriptors 0-2 directly
+    def _spawn_git(self, args, env=None, **kwargs):
+        if os.name == "posix":
+            kwargs.update(executable=self._git, close_fds=False)
+        return self.popen(args, env=self._env if env is None else env, **kwargs)
+
+    # Forward each line a git process writes to the log, tagged with its repository
+    def _pump(self, proc, prefix, on_line=None):
+        for line in proc.stdout:
+            # Whole lines only, so parallel repositories never split each other's output
+            self.log(f"[{prefix}] {line.rstrip()}\n")
+            if on_line:
+                on_line(line)
+
     # Clone new repositories or update existing ones
     def clone_or_update_repos(self, repos):
+        # Progress may start over when called on its own, after an earlier backup reached 100%
+        if self._last_percent >= 100:
+            self._last_percent = -1
         # Create a directory to store all repositories
         os.makedirs(self.__path, exist_ok=True)
         total = len(repos)
         if total == 0:
-            if self.progress:
-                self.progress(100)
+            self._report(100)
             return
 
-        # Progress from 10% to 100% during cloning/updating
-        for i, repo_url in enumerate(repos, 1):
-            # Extract the repository name (from the URL)
-            repo_name = repo_url.split("/")[-1].replace(".git", "")
-            repo_path = os.path.join(self.__path, repo_name)
-
-            # Clone the repo using subprocess to run the git command
-            if os.path.exists(repo_path):
-                # Change directory to the repo path and pull the latest changes
-                self.log(f"Updating {repo_name}...\n")
-                subprocess.run(["git", "-C", repo_path, "pull"])
-            else:
-                # Clone the repo using subprocess to run the git command
-                self.log(f"Cloning {repo_name}...\n")
-                subprocess.run(["git", "clone", repo_url, repo_path])
-
-            if self.progress:
-                # Map progress i/total from 10%-100%
-                percent = 10 + int((i / total) * 90)
-                self.progress(percent)
+        self._authorize_git()
+        self._share_ssh_connections(repos)
+        if self.combined:
+            self._sync_combined(repos)
+        else:
+            self._sync_each(repos)
 
         self.log("Backup completed.\n")
-        if self.progress:
-            self.progress(100)
+        self._report(100)
+
+    # Attach the gh token to git's requests to github.com, so git does not have to start
+    # a credential helper (which runs gh again) for every clone and fetch. The token travels
+    # in the environment only, never in command lines or the remote URLs saved to disk.
+    # Asked again on every backup, so a rotated token or a later gh login is picked up
+    def _authorize_git(self):
+        # Start over from the base environment, the last backup's header must not linger
+        self._env = self._base_env
+        try:
+            with self.popen(
+                ["gh", "auth", "token"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            ) as proc:
+                token = proc.stdout.read().strip()
+        except OSError:
+            # No gh, git falls back to its configured credential helper
+            return
+        if proc.returncode != 0 or not token:
+            return
+
+        credentials = base64.b64encode(f"x-access-token:{token}".encode()).decode()
+        self._env = _git_config_env(self._base_env, [(_AUTH_HEADER_KEY, f"Authorization: Basic {credentials}")])
+
+    # Let git processes talking to SSH remotes share one multiplexed connection. HTTPS
+    # remotes cannot share connections across processes, so only SSH URLs gain from this
+    def _share_ssh_connections(self, repos):
+        # Connection sharing is unavailable in Windows' OpenSSH, and the user's own ssh settings win
+        if os.name != "posix" or "GIT_SSH_COMMAND" in self._env or "GIT_SSH" in self._env:
+            return
+        if not any(repo_url.startswith(("git@", "ssh://")) for repo_url in repos):
+            return
+
+        _, configured = self._git_lines(["git", "config", "--get", "core.sshCommand"])
+        if configured:
+            return
+        try:
+            # Normally there already, it also holds known_hosts and the user's keys
+            os.makedirs(_SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+        except OSError:
+            # Nowhere private for the sockets, every git then opens its own connection
+            return
+        self._env = {**self._env, "GIT_SSH_COMMAND": _SSH_COMMAND}
+
+    # Keep one repository (clone or mirror) per GitHub repository, synced in parallel
+    def _sync_each(self, repos):
+        total = len(repos)
+
+        # List the backup folder once instead of checking every repository path on its own
+        with os.scandir(self.__path) as entries:
+            existing = {entry.name for entry in entries if entry.is_dir()}
+
+        # Stop the probe from finding a repository that merely encloses the backup folder
+        probe_env = {**self._env, "GIT_CEILING_DIRECTORIES": os.path.abspath(self.__path)}
+
+        # Run several git processes at once, network round trips dominate each one.
+        # Each pool thread just waits on its git child with the GIL released, and at most
+        # max_workers of them exist, so threads stay as cheap as an event loop would be here
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self._sync_one, repo_url, probe_env, existing) for repo_url in repos]
+
+            # Progress from 10% to 100% as repositories finish, in completion order
+            for done, future in enumerate(as_completed(futures), 1):
+                repo_name, status = future.result()
+                self.log(f"{status} {repo_name}.\n")
+
+                # Map progress done/total from 10%-100%
+                self._report(10 + int((done / total) * 90))
+
+    # Keep every repository as a remote of one bare repository, so a single
+    # git fetch updates them all and shares objects between forks
+    def _sync_combined(self, repos):
+        combined_path = os.path.join(self.__path, _COMBINED_DIR)
+        # Creates the repository on the first run, harmless re-initialisation afterwards
+        self._run_git(["git", "init", "--bare", "--quiet", combined_path], _COMBINED_DIR)
+
+        _, lines = self._git_lines(["git", "-C", combined_path, "remote"])
+        remotes = set(lines)
+
+        for repo_url in repos:
+            repo_name = _repo_name(repo_url)
+            if repo_name in remotes:
+                continue
+            self._run_git(["git", "-C", combined_path, "remote", "add", "--no-tags", repo_name, repo_url], repo_name)
+            # Keep each repository's tags in its own namespace, they would clash in refs/tags
+            self._run_git(["git", "-C", combined_path, "config", "--add", f"remote.{repo_name}.fetch",
+                           f"+refs/tags/*:refs/tags/{repo_name}/*"], repo_name)
+            remotes.add(repo_name)
+
+        # git announces each remote with a "Fetching <remote>" line, count those for progress
+        total = len(remotes)
+        fetched = set()
+
+        def on_line(line):
+            words = line.split()
+            if words and words[-1] in remotes and words[-1] not in fetched:
+                fetched.add(words[-1])
+                self._report(10 + int((len(fetched) / total) * 90))
+
+        returncode = self._run_git(
+            ["git", "-C", combined_path, "fetch", "--all", "--prune", f"--jobs={self.max_workers}"],
+            _COMBINED_DIR,
+            on_line,
+        )
+        if returncode != 0:
+            self.log("Failed to fetch some repositories.\n")
+
+
+# Repository name from its URL, only a trailing ".git" is dropped
+def _repo_name(repo_url):
+    return posixpath.basename(repo_url).removesuffix(".git")
+
+
+# Copy of environ that passes the given (key, value) pairs to git as configuration,
+# after any GIT_CONFIG_KEY_<n> entries the user already set
+def _git_config_env(environ, pairs):
+    env = dict(environ)
+    start = int(env.get("GIT_CONFIG_COUNT", 0))
+    for i, (key, value) in enumerate(pairs, start):
+        env[f"GIT_CONFIG_KEY_{i}"] = key
+        env[f"GIT_CONFIG_VALUE_{i}"] = value
+    env["GIT_CONFIG_COUNT"] = str(start + len(pairs))
+    return env
+
+
+# Extract clone URLs from gh --paginate output, which writes one JSON document per page back to back
+def _parse_pages(data):
+    if orjson:
+        # In valid JSON "}" can only be followed by "{" between documents, and these pages
+        # hold nothing but URLs and base64 cursors, so no string contains braces either
+        pages = [orjson.loads(chunk) for chunk in _PAGE_BOUNDARY.split(data.strip()) if chunk]
+        return [node["url"] for page in pages for node in page["data"]["viewer"]["repositories"]["nodes"]]
+
+    text = data.decode()
+    decoder = json.JSONDecoder()
+    urls = []
+    pos = 0
+    while True:
+        # Skip the whitespace gh may leave between pages
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos == len(text):
+            return urls
+        page, pos = decoder.raw_decode(text, pos)
+        urls.extend(node["url"] for node in page["data"]["viewer"]["repositories"]["nodes"])
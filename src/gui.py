@@ -5,7 +5,8 @@ from PySide6.QtWidgets import (
     QWidget, QLabel, QLineEdit, QPushButton,
     QVBoxLayout, QHBoxLayout, QFileDialog, QPlainTextEdit, QProgressBar
 )
-from PySide6.QtCore import Qt, QThread
+from PySide6.QtCore import Qt, QThread, QTimer, Signal
+from PySide6.QtGui import QTextCursor
 from src.worker import BackupWorker
 
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -14,11 +15,35 @@ DESTINATION_PATH = os.path.join(PROJECT_ROOT, "GitHub_Backups")
 
 # GUI class
 class BackupApp(QWidget):
+    # Asks the worker thread to back up into the given folder.
+    backup_requested = Signal(str)
+
     def __init__(self, /):
         super().__init__()
         self.setWindowTitle("GitHub Backup Tool")
         self.setMinimumWidth(500)
+        # Set while the worker is backing up, the window then stays open.
+        self.backup_running = False
         self.init_ui()
+        self.init_worker()
+
+    def init_worker(self):
+        # One worker thread for the lifetime of the window, each backup is queued onto it
+        # instead of starting and tearing down a new thread per click.
+        self.thread = QThread()
+        self.worker = BackupWorker("")
+        self.worker.moveToThread(self.thread)
+
+        # Connect signals.
+        self.backup_requested.connect(self.worker.run)
+        self.worker.log_signal.connect(self.log)
+        self.worker.progress_signal.connect(self.update_progress)
+
+        # Re-enable UI after backup completes, through a method so it runs on the GUI thread.
+        self.worker.finished.connect(self.backup_finished)
+
+        # Start thread.
+        self.thread.start()
 
     def init_ui(self):
         # Layouts.
@@ -59,10 +84,18 @@ class BackupApp(QWidget):
         # Output log area.
         self.output_box = QPlainTextEdit()
         self.output_box.setReadOnly(True)
+        # Cursor kept at the end of the log, new text is inserted through it.
+        self.log_cursor = QTextCursor(self.output_box.document())
 
         # Progress bar.
         self.progress_bar = QProgressBar()
         self.progress_bar.setRange(0, 100)
+        # Repaint the bar at most every 33ms, showing only the latest value.
+        self.pending_progress = 0
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setSingleShot(True)
+        self.progress_timer.setInterval(33)
+        self.progress_timer.timeout.connect(self.apply_progress)
 
         # Start button.
         self.start_button = QPushButton("Start Backup")
@@ -82,10 +115,24 @@ class BackupApp(QWidget):
             self.path_input.setText(folder)
 
     def log(self, message):
-        self.output_box.appendPlainText(message)
+        # Messages arrive in batches that carry their own newlines, so insert them as-is
+        # instead of appending a new paragraph per call.
+        scroll_bar = self.output_box.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        self.log_cursor.movePosition(QTextCursor.MoveOperation.End)
+        self.log_cursor.insertText(message)
+        # Keep following the output unless the user scrolled up to read.
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
 
     def update_progress(self, value):
-        self.progress_bar.setValue(value)
+        # Remember the value and let the timer paint it, however fast the worker reports.
+        self.pending_progress = value
+        if not self.progress_timer.isActive():
+            self.progress_timer.start()
+
+    def apply_progress(self):
+        self.progress_bar.setValue(self.pending_progress)
 
     def start_backup(self):
         path = self.path_input.text().strip()
@@ -95,25 +142,27 @@ class BackupApp(QWidget):
 
         # Disable UI during backup.
         self.toggle_ui(False)
+        self.backup_running = True
 
-        # Create thread and worker.
-        self.thread = QThread()
-        self.worker = BackupWorker(path)
-        self.worker.moveToThread(self.thread)
+        # Run it on the worker thread.
+        self.backup_requested.emit(path)
 
-        # Connect signals.
-        self.thread.started.connect(self.worker.run)
-        self.worker.log_signal.connect(self.log)
-        self.worker.progress_signal.connect(self.update_progress)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
+    def backup_finished(self):
+        self.backup_running = False
+        self.toggle_ui(True)
 
-        # Re-enable UI after backup completes
-        self.thread.finished.connect(lambda: self.toggle_ui(True))
+    def closeEvent(self, event):
+        # Waiting here for the clones still in flight would freeze the window, so it stays
+        # open until the backup is done.
+        if self.backup_running:
+            self.log("A backup is still running, close the window once it has completed.\n")
+            event.ignore()
+            return
 
-        # Start thread.
-        self.thread.start()
+        # Stop the idle worker thread.
+        self.thread.quit()
+        self.thread.wait()
+        super().closeEvent(event)
 
     def toggle_ui(self, enabled: bool):
         # Enable or disable UI components during backup.
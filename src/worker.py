@@ -1,7 +1,46 @@
 # worker.py
-from PySide6.QtCore import QObject, Signal
+import threading
+
+from PySide6.QtCore import QObject, Signal, Slot
 from src.backup import GithubBackup
 
+# Hand buffered log text to the GUI at most this often (seconds),
+# or straight away once this many messages are waiting.
+LOG_FLUSH_INTERVAL = 0.05
+LOG_FLUSH_MESSAGES = 16
+
+
+# Collects log messages from any thread and passes them on in batches
+class LogBuffer:
+    def __init__(self, emit):
+        self.emit = emit
+        self.messages = []
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def write(self, message):
+        with self.lock:
+            self.messages.append(message)
+            if len(self.messages) >= LOG_FLUSH_MESSAGES:
+                self._flush_locked()
+            elif self.timer is None:
+                # First message of a new batch, make sure it goes out soon
+                self.timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.messages:
+            self.emit("".join(self.messages))
+            self.messages.clear()
+
 
 class BackupWorker(QObject):
     log_signal = Signal(str)
@@ -11,19 +50,28 @@ class BackupWorker(QObject):
     def __init__(self, path):
         super().__init__()
         self.path = path
+        # One signal per batch instead of one per message, parallel clones log a lot
+        self.log_buffer = LogBuffer(self.log_signal.emit)
+        # Kept across backups. Per-run state, such as the gh token and git's environment,
+        # is looked up again at the start of every backup, so a new gh login is picked up
+        self.backup = GithubBackup(path, self.log_buffer.write, self.progress_signal.emit)
 
-    def run(self):
-        def log(message):
-            self.log_signal.emit(message)
-
-        def progress(value):
-            self.progress_signal.emit(value)
-
-        backup = GithubBackup(self.path, log, progress)
-        repos = backup.fetch_repos()
+    @Slot(str)
+    def run(self, path):
+        self.path = path
+        try:
+            self.backup.set_path(path)
+            repos = self.backup.fetch_repos()
 
-        if repos:
-            backup.clone_or_update_repos(repos)
-        else:
-            log("No repositories found.\n")
-        self.finished.emit()
+            if repos:
+                self.backup.clone_or_update_repos(repos)
+            else:
+                self.log_buffer.write("No repositories found.\n")
+        except Exception as e:
+            # An unwritable folder or a failing worker ends this backup, not the app
+            self.log_buffer.write(f"Backup failed: {e}\n")
+        finally:
+            # Deliver whatever is still buffered, and always report completion so the
+            # GUI re-enables itself and can be closed again
+            self.log_buffer.flush()
+            self.finished.emit()
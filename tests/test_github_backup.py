@@ -1,11 +1,164 @@
-import sys
-import os
+import base64
+import io
 import json
+import os
+import subprocess
 import unittest
-from unittest.mock import patch, MagicMock
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest.mock import call, patch, MagicMock
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+from src.backup import GithubBackup, _REPOS_QUERY, _URLS_PREFIX, _repo_name
+
+# Backup folder the tests point GithubBackup at, nothing is ever written there.
+BACKUP_PATH = "Test_GitHub_Backups"
+# Where each repository the tests use is expected inside the backup folder, joined once.
+REPO_PATHS = {name: os.path.join(BACKUP_PATH, name) for name in (
+    "existing_repo.git", "new_repo.git", ".superbackup", "user.github.io",
+)}
+
+# Two repositories as gh prints them without --jq, --paginate writes one JSON document per page.
+FETCH_REPOS_URLS = ["https://github.com/user/repo1.git", "https://github.com/user/repo2.git"]
+FETCH_REPOS_PAGES = [json.dumps({"data": {"viewer": {"repositories": {"nodes": [{"url": url}]}}}}).encode()
+                     for url in FETCH_REPOS_URLS]
+
+# Keyword arguments git commands are started with, their output is streamed to the log.
+# The posix_spawn keywords are only added on POSIX, Windows keeps Popen's defaults.
+POSIX_SPAWN = dict(executable=unittest.mock.ANY, close_fds=False) if os.name == "posix" else {}
+GIT_OUTPUT = dict(env=unittest.mock.ANY, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, text=True,
+                  encoding="utf-8", errors="replace",
+                  **POSIX_SPAWN)
+
+
+def mock_process(returncode, stdout, stderr=""):
+    """
+    Builds a mock of a finished gh or git process usable as a Popen context manager.
+    Text output is served as str and bytes output as bytes, like the real pipes.
+    """
+    stream = io.BytesIO if isinstance(stdout, bytes) else io.StringIO
+    # Specced against Popen, so a misspelt attribute fails instead of returning a new mock.
+    mock_proc = MagicMock(spec=subprocess.Popen, returncode=returncode)
+    mock_proc.stdout = stream(stdout)
+    mock_proc.stderr = stream(stderr.encode() if isinstance(stdout, bytes) else stderr)
+    mock_proc.__enter__.return_value = mock_proc
+    return mock_proc
+
+
+@pytest.mark.parametrize("outputs,expected", [
+    # gh prints one URL per line through --jq, blank lines are skipped.
+    ([(0, b"https://github.com/user/repo1.git\nhttps://github.com/user/repo2.git\n\n")],
+     ["https://github.com/user/repo1.git", "https://github.com/user/repo2.git"]),
+    # gh itself fails (e.g. not logged in).
+    ([(1, b"", "Error: gh command failed")], []),
+    # gh lacks --jq, and the JSON it prints instead is malformed.
+    ([(1, b"", "unknown flag: --jq"), (0, b"This is not valid JSON")], []),
+], ids=["success", "cli_error", "json_decode_error"])
+def test_fetch_repos(outputs, expected):
+    """
+    Tests fetching repository URLs from the outputs of the gh processes it starts.
+    """
+    mock_popen = MagicMock(side_effect=[mock_process(*output) for output in outputs])
+
+    # Call the method under test.
+    repos = GithubBackup(BACKUP_PATH, lambda message: None, popen=mock_popen).fetch_repos()
+
+    # Assert that the returned list of repositories matches the expected URLs.
+    assert repos == expected
+    # Verify that no gh process is started beyond the listing and its fallback.
+    assert mock_popen.call_count == len(outputs)
+    # Verify that the URLs are always listed first by one paginated 'gh api graphql' call.
+    assert mock_popen.call_args_list[0] == call(
+        ["gh", "api", "graphql", "--paginate", "-f", f"query={_REPOS_QUERY}",
+         "--jq", ".data.viewer.repositories.nodes[].url"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+
+def test_fetch_repos_cache_is_opt_in():
+    """
+    Tests that gh's listing cache, which may miss repositories created since, is only used when asked for.
+    """
+    mock_popen = MagicMock(side_effect=[mock_process(0, b"https://github.com/user/repo1.git\n")])
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from src.backup import GithubBackup
+    # Call the method under test with a five minute cache.
+    GithubBackup(BACKUP_PATH, lambda message: None, cache_ttl="5m", popen=mock_popen).fetch_repos()
+
+    # Assert that gh was allowed to answer from its cache for that long.
+    assert mock_popen.call_args.args[0][-2:] == ["--cache", "5m"]
+
+def test_fetch_repos_logs_gh_errors():
+    """
+    Tests that gh's own error message reaches the log, which is why its stderr is
+    captured through a pipe rather than sent to DEVNULL.
+    """
+    mock_popen = MagicMock(side_effect=[mock_process(1, b"", "HTTP 401: Bad credentials\n")])
+    messages = []
+
+    # Call the method under test.
+    repos = GithubBackup(BACKUP_PATH, messages.append, popen=mock_popen).fetch_repos()
+
+    # Assert that nothing was listed and the user is told why.
+    assert repos == []
+    assert "Error fetching repositories: HTTP 401: Bad credentials\n" in messages
+    assert mock_popen.call_args.kwargs["stderr"] == subprocess.PIPE
+
+
+
+def test_fetch_repos_without_gh():
+    """
+    Tests that a missing GitHub CLI is reported instead of raising out of fetch_repos.
+    """
+    mock_popen = MagicMock(side_effect=FileNotFoundError(2, "No such file or directory", "gh"))
+    messages = []
+
+    # Call the method under test.
+    repos = GithubBackup(BACKUP_PATH, messages.append, popen=mock_popen).fetch_repos()
+
+    # Assert that nothing was listed and the user is told gh could not be run.
+    assert repos == []
+    assert any(message.startswith("Error running the GitHub CLI (gh): ") for message in messages)
+
+def test_fetch_repos_uses_one_gh_call():
+    """
+    Tests that every repository, across several GraphQL pages, is listed by a single gh process
+    instead of one process per page or per repository.
+    """
+    urls = [f"https://github.com/user/repo{i}.git" for i in range(250)]
+    # gh --paginate walks all three pages of 100 and --jq prints every URL on its own line.
+    mock_popen = MagicMock(side_effect=[mock_process(0, "".join(f"{url}\n" for url in urls).encode())])
+
+    # Call the method under test.
+    repos = GithubBackup(BACKUP_PATH, lambda message: None, popen=mock_popen).fetch_repos()
+
+    # Assert that all three pages came out of one gh process.
+    assert repos == urls
+    assert mock_popen.call_count == 1
+
+
+def test_fetch_repos_fallback_parses_all_pages():
+    """
+    Tests that the fallback for gh releases without --jq keeps every repository across several
+    GraphQL pages, listed by one gh process after the rejected --jq attempt.
+    """
+    urls = [f"https://github.com/user/repo{i}.git" for i in range(250)]
+    # gh --paginate writes one JSON document per page of 100, back to back.
+    nodes = [{"url": url} for url in urls]
+    pages = b"".join(json.dumps({"data": {"viewer": {"repositories": {"nodes": nodes[i:i + 100]}}}}).encode()
+                     for i in range(0, len(nodes), 100))
+    # Let gh reject --jq, so the pages are parsed on the Python side.
+    mock_popen = MagicMock(side_effect=[mock_process(1, b"", "unknown flag: --jq"), mock_process(0, pages)])
+
+    # Call the method under test.
+    repos = GithubBackup(BACKUP_PATH, lambda message: None, popen=mock_popen).fetch_repos()
+
+    # Assert that all three pages came out of the one listing started after the rejected --jq attempt.
+    assert repos == urls
+    assert mock_popen.call_count == 2
 
 
 class TestGithubBackup(unittest.TestCase):
@@ -16,212 +169,605 @@ class TestGithubBackup(unittest.TestCase):
        actual GitHub API interaction or file system changes.
     """
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        """
+        Set up once for the whole suite.
+        Creates a single GithubBackup instance shared by the tests, since only
+        the mocks change between them. Git, gh and os.makedirs are mocked, so
+        nothing is ever written to the test path.
         """
-       Set up for each test.
-       Initializes a GithubBackup instance with a test-specific path
-       and ensures the test backup directory is clean.
-       """
-        # Define a temporary path for testing backups to avoid interfering with actual backups.
-        self.test_backup_path = "Test_GitHub_Backups"
+        # Define a path for testing backups to avoid interfering with actual backups.
+        cls.test_backup_path = BACKUP_PATH
         # Create an instance of GithubBackup using the test path.
-        self.github_backup_instance = GithubBackup(self.test_backup_path, self.mock_log)
-
-        # Remove the test backup directory if it exists from a previous run to ensure a clean state.
-        if os.path.exists(self.test_backup_path):
-            import shutil
-            shutil.rmtree(self.test_backup_path)
+        cls.github_backup_instance = GithubBackup(cls.test_backup_path, lambda message: None)
 
-    def tearDown(self):
+    def setUp(self):
+        """
+        Set up for each test.
+        Points the shared instance back at the test path, in case a test moved it, and
+        replaces process creation and the filesystem calls of a backup. The mocks are kept
+        on the test as mock_popen, mock_scandir and mock_makedirs; mock_popen is handed to
+        the shared instance, other instances take it as popen. Done here rather than in a
+        pytest fixture so the suite also runs under plain unittest.
         """
-        Clean up after each test.
-        Removes the test backup directory to ensure test isolation.
-       """
-        # Remove the test backup directory after each test to clean up.
-        if os.path.exists(self.test_backup_path):
-            import shutil
-            shutil.rmtree(self.test_backup_path)
+        self.github_backup_instance.set_path(self.test_backup_path)
+        self.mock_popen = MagicMock()
+        self.mock_scandir = MagicMock()
+        self.mock_makedirs = MagicMock()
+        for patcher in (
+            patch.object(self.github_backup_instance, "popen", self.mock_popen),
+            patch("os.scandir", self.mock_scandir),
+            patch("os.makedirs", self.mock_makedirs),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def mock_log(self, message):
         pass
 
-    @patch("subprocess.run")
-    def test_fetch_repos_success(self, mock_subprocess_run):
+    def mock_git(self, is_repo, returncode=0, output="", outputs=None):
         """
-        Tests successful fetching of repository URLs.
-        Mocks a successful 'gh repo list' command output.
+        Builds a subprocess.Popen side effect for git commands.
+        The 'rev-parse' repository probe succeeds only for paths accepted by is_repo,
+        commands naming a key of outputs (e.g. 'ls-remote') write that output,
+        every other git command exits with returncode after writing output.
         """
-        # Configure the mock subprocess.run to simulate a successful gh repo list command.
-        mock_result = MagicMock()
-        # Indicate success.
-        mock_result.returncode = 0
-
-        # Simulate the JSON output from a successful 'gh repo list --json url'.
-        mock_result.stdout = json.dumps([
-            {"url": "https://github.com/user/repo1.git"},
-            {"url": "https://github.com/user/repo2.git"},
-        ])
+        def popen(args, **kwargs):
+            if args[3:] == ["rev-parse", "--git-dir"]:
+                return MagicMock(spec=subprocess.Popen, **{"wait.return_value": 0 if is_repo(args[2]) else 128})
+            for command, command_output in (outputs or {}).items():
+                if command in args:
+                    return self.mock_process(0, command_output)
+            return self.mock_process(returncode, output)
+        return popen
+
+    def mock_listing(self, names):
+        """
+        Configures the os.scandir mock to list the given folder names in the backup directory.
+        """
+        # Only the name and is_dir() of an entry are read, a plain namespace is enough.
+        entries = [SimpleNamespace(name=name, is_dir=lambda: True) for name in names]
+        self.mock_scandir.return_value.__enter__.return_value = entries
 
-        # No errors.
-        mock_result.stderr = ""
+    mock_process = staticmethod(mock_process)
 
-        # Set the return value of the mocked subprocess.run.
-        mock_subprocess_run.return_value = mock_result
+    def test_fetch_repos_without_jq_support(self):
+        """
+        Tests the fallback for gh releases that do not know the --jq flag.
+        The raw JSON pages are requested and parsed on the Python side.
+        """
+        # First call rejects --jq, second call returns two JSON pages back to back as bytes.
+        self.mock_popen.side_effect = [
+            self.mock_process(1, b"", "unknown flag: --jq"),
+            self.mock_process(0, b"".join(FETCH_REPOS_PAGES)),
+        ]
 
         # Call the method under test.
         repos = self.github_backup_instance.fetch_repos()
 
-        # Assert that the returned list of repositories matches the expected URLs.
-        self.assertEqual(repos, [
-            "https://github.com/user/repo1.git",
-            "https://github.com/user/repo2.git"
-        ])
-
-        # Verify that subprocess.run was called exactly once with the correct arguments.
-        mock_subprocess_run.assert_called_once_with(
-            ["gh", "repo", "list", "--json", "url", "--limit", "1000"],
-            capture_output=True,
-            text=True,
+        # Assert that the URLs were extracted from the JSON output.
+        self.assertEqual(repos, FETCH_REPOS_URLS)
+        # Verify that the fallback asked for plain JSON without the jq filter.
+        self.assertEqual(
+            self.mock_popen.call_args_list[1].args[0],
+            ["gh", "api", "graphql", "--paginate", "-f", f"query={_REPOS_QUERY}"],
         )
 
-    @patch("subprocess.run")
-    def test_fetch_repos_cli_errors(self, mock_subprocess_run):
+    @patch("src.backup.ijson", None)
+    def test_fetch_repos_without_jq_or_fast_parsers(self):
         """
-        Tests handling of errors from the GitHub CLI (e.g., gh not found).
-        Mocks a failed 'gh repo list' command.
+        Tests the fallback JSON parsing when neither ijson nor orjson is installed.
         """
-        # Configure the mock subprocess.run to simulate a failed gh repo list command.
-        mock_result = MagicMock()
-        # Indicate failure.
-        mock_result.returncode = 1
-        mock_result.stdout = ""
-        # Simulate an error message.
-        mock_result.stderr = "Error: gh command failed"
-        mock_subprocess_run.return_value = mock_result
+        # The pages are separated by newlines this time.
+        self.mock_popen.side_effect = [
+            self.mock_process(1, b"", "unknown flag: --jq"),
+            self.mock_process(0, b"\n".join(FETCH_REPOS_PAGES) + b"\n"),
+        ]
 
-        # Call the method under test.
-        repos = self.github_backup_instance.fetch_repos()
-        # Assert that an empty list is returned when the CLI command fails.
-        self.assertEqual(repos, [])
-        # We're primarily testing the return value (empty list) for this scenario.
-
-    @patch("subprocess.run")
-    def test_fetch_repos_json_decode_error(self, mock_subprocess_run):
-        """
-       Tests handling of invalid JSON output from the GitHub CLI.
-       Mocks gh returning malformed JSON.
-       """
-        # Configure the mock subprocess.run to simulate invalid JSON output.
-        mock_result = MagicMock()
-        # Command succeeded but output is malformed.
-        mock_result.returncode = 0
-        # Non-JSON string.
-        mock_result.stdout = "This is not valid JSON"
-        mock_result.stderr = ""
-        mock_subprocess_run.return_value = mock_result
+        # Call the method under test with the standard library parser only.
+        with patch("src.backup.orjson", None):
+            repos = self.github_backup_instance.fetch_repos()
 
-        # Call the method under test.
-        repos = self.github_backup_instance.fetch_repos()
-        # Assert that an empty list is returned when JSON decoding fails.
+        # Assert that both pages were parsed.
+        self.assertEqual(repos, FETCH_REPOS_URLS)
+
+    def test_fetch_repos_without_jq_with_ijson(self):
+        """
+        Tests that the fallback streams the URLs through ijson when it is installed,
+        without needing ijson itself, by standing in a fake module for it.
+        """
+        fake_ijson = SimpleNamespace(items=MagicMock(return_value=iter(FETCH_REPOS_URLS)))
+        listing = self.mock_process(0, b"".join(FETCH_REPOS_PAGES))
+        self.mock_popen.side_effect = [self.mock_process(1, b"", "unknown flag: --jq"), listing]
+
+        # Call the method under test with ijson "installed".
+        with patch("src.backup.ijson", fake_ijson):
+            repos = self.github_backup_instance.fetch_repos()
+
+        # Assert that the URLs came from ijson, read straight off gh's stdout across all pages.
+        self.assertEqual(repos, FETCH_REPOS_URLS)
+        fake_ijson.items.assert_called_once_with(listing.stdout, _URLS_PREFIX, multiple_values=True)
+
+    def test_fetch_repos_reports_ijson_errors(self):
+        """
+        Tests that malformed JSON found by ijson is reported instead of raising out of fetch_repos.
+        """
+        # ijson's JSONError is not a ValueError, it is caught because it is added to the handled errors.
+        class JSONError(Exception):
+            pass
+
+        fake_ijson = SimpleNamespace(items=MagicMock(side_effect=JSONError("lexical error")), JSONError=JSONError)
+        self.mock_popen.side_effect = [
+            self.mock_process(1, b"", "unknown flag: --jq"),
+            self.mock_process(0, b"This is not valid JSON"),
+        ]
+        messages = []
+
+        # Call the method under test with ijson "installed", as the import at the top of backup.py sets it up.
+        with patch("src.backup.ijson", fake_ijson), \
+                patch("src.backup._JSON_ERRORS", (ValueError, KeyError, TypeError, JSONError)), \
+                patch.object(self.github_backup_instance, "log", messages.append):
+            repos = self.github_backup_instance.fetch_repos()
+
+        # Assert that nothing was listed and the user is told why.
         self.assertEqual(repos, [])
+        self.assertIn("Failed to parse JSON: lexical error\n", messages)
 
-    @patch('subprocess.run')
-    @patch('os.path.exists')
-    @patch('os.makedirs')
-    def test_clone_new_repos(self, mock_makedirs, mock_path_exists, mock_subprocess_run):
+    @patch("src.backup.ijson", None)
+    def test_fetch_repos_without_jq_with_orjson(self):
         """
-        Tests the cloning of new repositories that don't exist locally.
-        Mocks file system checks and git clone commands.
+        Tests that without ijson the fallback splits gh's pages and parses each one with orjson,
+        standing in a fake module for it so the branch runs whether or not orjson is installed.
         """
-        # Configure os.path.exists to always return False, simulating non-existent local repos.
-        mock_path_exists.return_value = False
-        repos_to_clone = [
-            "https://github.com/user/new_repo1.git",
-            "https://github.com/user/new_repo2.git"
+        fake_orjson = SimpleNamespace(loads=MagicMock(side_effect=json.loads))
+        # The pages are separated by a newline, as gh may print them.
+        self.mock_popen.side_effect = [
+            self.mock_process(1, b"", "unknown flag: --jq"),
+            self.mock_process(0, b"\n".join(FETCH_REPOS_PAGES) + b"\n"),
         ]
 
+        # Call the method under test with orjson "installed".
+        with patch("src.backup.orjson", fake_orjson):
+            repos = self.github_backup_instance.fetch_repos()
+
+        # Assert that every page was handed to orjson on its own, without the whitespace between them.
+        self.assertEqual(repos, FETCH_REPOS_URLS)
+        self.assertEqual(fake_orjson.loads.call_args_list, [call(page) for page in FETCH_REPOS_PAGES])
+
+    def test_repos_are_synced_in_parallel(self):
+        """
+        Tests that every repository is handed to a thread pool bounded by max_workers,
+        rather than cloned one after another in the calling thread.
+        """
+        self.mock_popen.side_effect = self.mock_git(lambda path: False)
+        self.mock_listing([])
+
+        # A pool that runs each submitted job right away and returns its finished future.
+        def submit(fn, *args):
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+        mock_pool = MagicMock()
+        mock_pool.__enter__.return_value.submit.side_effect = submit
+        backup = GithubBackup(self.test_backup_path, self.mock_log, max_workers=3, popen=self.mock_popen)
+        repos = [f"https://github.com/user/new_repo{i}.git" for i in range(5)]
+
         # Call the method under test.
-        self.github_backup_instance.clone_or_update_repos(repos_to_clone)
+        with patch("src.backup.ThreadPoolExecutor", return_value=mock_pool) as mock_executor:
+            backup.clone_or_update_repos(repos)
 
-        # Verify that the destination directory was created (or checked for existence with exist_ok=True).
-        mock_makedirs.assert_called_once_with(self.test_backup_path, exist_ok=True)
+        # Assert that one pool of max_workers threads was given one job per repository.
+        mock_executor.assert_called_once_with(max_workers=3)
+        self.assertEqual(mock_pool.__enter__.return_value.submit.call_count, len(repos))
 
-        # Assert that 'git clone' was called for each new repository with the correct arguments.
-        mock_subprocess_run.assert_any_call(
-            ["git", "clone", "https://github.com/user/new_repo1.git", os.path.join(self.test_backup_path, "new_repo1")]
-        )
-        mock_subprocess_run.assert_any_call(
-            ["git", "clone", "https://github.com/user/new_repo2.git", os.path.join(self.test_backup_path, "new_repo2")]
-        )
-        # Ensure 'git pull' was not called, as these are new clones and not updates.
-        # The '...' acts as a wildcard for arguments we do not care about in this specific check.
-        self.assertNotIn(["git", "-C", unittest.mock.ANY, "pull"], mock_subprocess_run.call_args_list)
-
-    @patch('subprocess.run')
-    @patch('os.path.exists')
-    @patch('os.makedirs')
-    def test_update_existing_repos(self, mock_makedirs, mock_path_exists, mock_subprocess_run):
-        """
-        Tests the updating (pulling) of repositories that already exist locally.
-        Mocks file system checks and git pull commands.
-        """
-        # Configure os.path.exists to always return True, simulating existing local repos.
-        mock_path_exists.return_value = True
-        repos_to_update = [
-            "https://github.com/user/existing_repo1.git",
-            "https://github.com/user/existing_repo2.git"
-        ]
+    def test_backup_folder_is_created(self):
+        """
+        Tests that the backup folder is created, or checked for existence with exist_ok=True,
+        once per backup, even when there is nothing to back up.
+        """
+        # Call the method under test.
+        self.github_backup_instance.clone_or_update_repos([])
+
+        # Verify that the destination directory was created once.
+        self.mock_makedirs.assert_called_once_with(self.test_backup_path, exist_ok=True)
+
+    @settings(max_examples=50, deadline=None)
+    @given(repos=st.lists(
+        st.tuples(st.from_regex(r"https://github\.com/user/[a-z_]+\.git", fullmatch=True), st.booleans()),
+        max_size=20,
+        unique_by=lambda repo: repo[0],
+    ))
+    def test_clone_or_update_repos(self, repos):
+        """
+        Tests cloning and updating over generated mixes of new and already backed up repositories:
+        each repository is pulled if it exists locally and cloned otherwise, never both.
+        """
+        # Each generated case starts from fresh mocks, the fixture runs once for all of them.
+        self.mock_popen.reset_mock()
+        existing = {_repo_name(url) for url, exists in repos if exists}
+        # Only the folders listed in the backup folder are probed, and git accepts them all.
+        self.mock_popen.side_effect = self.mock_git(lambda path: True)
+        self.mock_listing(existing)
 
         # Call the method under test.
-        self.github_backup_instance.clone_or_update_repos(repos_to_update)
+        self.github_backup_instance.clone_or_update_repos([url for url, _ in repos])
+
+        commands = [c.args[0] for c in self.mock_popen.call_args_list]
+        for url, exists in repos:
+            path = os.path.join(self.test_backup_path, _repo_name(url))
+            pull = ["git", "-C", path, "pull"]
+            clone = ["git", "clone", url, path]
+            if exists:
+                # Assert that an existing repository was pulled and not cloned again.
+                self.mock_popen.assert_any_call(pull, **GIT_OUTPUT)
+                self.assertNotIn(clone, commands)
+            else:
+                # Assert that a new repository was cloned and not pulled.
+                self.mock_popen.assert_any_call(clone, **GIT_OUTPUT)
+                self.assertNotIn(pull, commands)
+
+        # Ensure only the listed folders were probed, and that the probe cannot walk up
+        # past the backup folder into an enclosing repository.
+        probes = [c for c in self.mock_popen.call_args_list if "rev-parse" in c.args[0]]
+        self.assertEqual({os.path.basename(c.args[0][2]) for c in probes}, existing)
+        for probe in probes:
+            self.assertEqual(probe.kwargs["env"]["GIT_CEILING_DIRECTORIES"], os.path.abspath(self.test_backup_path))
+
+    def test_mirror_repos(self):
+        """
+        Tests the mirror mode, which keeps bare partial clones named '<repo>.git'
+        and refreshes their branches with 'git fetch'.
+        """
+        # Simulate an existing mirror and a repository that is not backed up yet.
+        # GitHub has a branch the existing mirror does not have yet.
+        self.mock_popen.side_effect = self.mock_git(lambda path: "existing_repo" in path,
+                                               outputs={"ls-remote": "1111\trefs/heads/main\n"})
+        self.mock_listing(["existing_repo.git"])
+        backup = GithubBackup(self.test_backup_path, self.mock_log, mirror=True, partial=True, popen=self.mock_popen)
+
+        # Call the method under test.
+        backup.clone_or_update_repos([
+            "https://github.com/user/existing_repo.git",
+            "https://github.com/user/new_repo.git"
+        ])
 
-        # Verify that the destination directory was created (or checked for existence)
-        mock_makedirs.assert_called_once_with(self.test_backup_path, exist_ok=True)
-        # Assert that 'git pull' was called for each existing repository with the correct arguments.
-        mock_subprocess_run.assert_any_call(
-            ["git", "-C", os.path.join(self.test_backup_path, "existing_repo1"), "pull"]
+        # Assert that the existing mirror was fetched into its own branches.
+        self.mock_popen.assert_any_call(
+            ["git", "-C", REPO_PATHS["existing_repo.git"], "fetch", "--prune",
+             "--filter=blob:none", "origin", "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"],
+            **GIT_OUTPUT,
         )
-        mock_subprocess_run.assert_any_call(
-            ["git", "-C", os.path.join(self.test_backup_path, "existing_repo2"), "pull"]
+        # Assert that the new repository was cloned bare without blobs.
+        self.mock_popen.assert_any_call(
+            ["git", "clone", "--bare", "--filter=blob:none", "https://github.com/user/new_repo.git",
+             REPO_PATHS["new_repo.git"]],
+            **GIT_OUTPUT,
         )
-        # Ensure 'git clone' was not called, as these are updates and not new clones.
-        self.assertNotIn(["git", "clone", unittest.mock.ANY, unittest.mock.ANY], mock_subprocess_run.call_args_list)
 
-    @patch('subprocess.run')
-    @patch('os.path.exists')
-    @patch('os.makedirs')
-    def test_clone_and_update_mixed_repos(self, mock_makedirs, mock_path_exists, mock_subprocess_run):
+    def test_mirror_with_deleted_branch_is_fetched(self):
+        """
+        Tests that a mirror still holding a branch deleted on GitHub is fetched, so --prune removes it,
+        while an exactly matching mirror is skipped.
+        """
+        ls_remote = "1111\trefs/heads/main\n2222\trefs/tags/v1\n1111\trefs/tags/v1^{}\n"
+        for local_refs, fetched in (
+            # Same branches and tags as GitHub.
+            ("* 1111 refs/heads/main \n  2222 refs/tags/v1 \n", False),
+            # A branch that only exists locally any more.
+            ("* 1111 refs/heads/main \n  3333 refs/heads/deleted \n  2222 refs/tags/v1 \n", True),
+        ):
+            with self.subTest(fetched=fetched):
+                self.mock_popen.reset_mock()
+                self.mock_popen.side_effect = self.mock_git(lambda path: True, outputs={
+                    "ls-remote": ls_remote,
+                    "for-each-ref": local_refs,
+                })
+                self.mock_listing(["existing_repo.git"])
+                backup = GithubBackup(self.test_backup_path, self.mock_log, mirror=True, popen=self.mock_popen)
+
+                # Call the method under test.
+                backup.clone_or_update_repos(["https://github.com/user/existing_repo.git"])
+
+                # Assert that the mirror was fetched only when its refs differ from GitHub's.
+                commands = [c.args[0] for c in self.mock_popen.call_args_list]
+                self.assertEqual(any("fetch" in command for command in commands), fetched)
+
+    def test_combined_repos(self):
         """
-        Tests the mixed scenario of cloning new and updating existing repositories.
+        Tests the combined mode, which keeps every repository as a remote of one bare
+        repository and updates all of them with a single 'git fetch --all'.
         """
+        combined_path = REPO_PATHS[".superbackup"]
 
-        # Define a side effect for os.path.exists to simulate a mix of existing and new repositories.
-        def path_exists_side_effect(path):
-            # Returns True if "existing_repo" is in the path, otherwise False.
-            if "existing_repo" in path:
-                return True  # Simulate existing
-            return False  # Simulate new
+        def popen(args, **kwargs):
+            # 'existing_repo' is already a remote, git fetch announces both remotes.
+            if args[3:] == ["remote"]:
+                return self.mock_process(0, "existing_repo\n")
+            if "fetch" in args:
+                return self.mock_process(0, "Fetching existing_repo\nFetching new_repo\n")
+            return self.mock_process(0, "")
 
-        mock_path_exists.side_effect = path_exists_side_effect
+        self.mock_popen.side_effect = popen
+        progress = []
+        backup = GithubBackup(self.test_backup_path, self.mock_log, progress.append, combined=True,
+                              popen=self.mock_popen)
 
-        repos_mixed = [
+        # Call the method under test.
+        backup.clone_or_update_repos([
             "https://github.com/user/existing_repo.git",
             "https://github.com/user/new_repo.git"
-        ]
+        ])
+
+        commands = [c.args[0] for c in self.mock_popen.call_args_list]
+        # Assert that only the new repository was added as a remote, with its tags namespaced.
+        self.assertIn(["git", "-C", combined_path, "remote", "add", "--no-tags", "new_repo",
+                       "https://github.com/user/new_repo.git"], commands)
+        self.assertIn(["git", "-C", combined_path, "config", "--add", "remote.new_repo.fetch",
+                       "+refs/tags/*:refs/tags/new_repo/*"], commands)
+        self.assertNotIn("existing_repo", [c[5] for c in commands if c[3:5] == ["remote", "add"]])
+        # Assert that one fetch updated every remote, and progress followed the announced remotes.
+        self.assertEqual(commands[-1], ["git", "-C", combined_path, "fetch", "--all", "--prune", "--jobs=8"])
+        self.assertEqual(progress, [55, 100])
+
+    def test_unchanged_repo_is_skipped(self):
+        """
+        Tests that a clone whose branches and tags already match GitHub is not pulled.
+        """
+        self.mock_popen.side_effect = self.mock_git(lambda path: True, outputs={
+            # GitHub's branch and annotated tag, with the tag's peeled entry.
+            "ls-remote": "1111\trefs/heads/main\n2222\trefs/tags/v1\n1111\trefs/tags/v1^{}\n",
+            # The checked out branch matches its upstream, which matches GitHub.
+            "for-each-ref": "* 1111 refs/heads/main refs/remotes/origin/main\n"
+                            "  1111 refs/remotes/origin/HEAD \n"
+                            "  1111 refs/remotes/origin/main \n"
+                            "  2222 refs/tags/v1 \n",
+        })
+        self.mock_listing(["existing_repo"])
+        messages = []
+        backup = GithubBackup(self.test_backup_path, messages.append, popen=self.mock_popen)
 
         # Call the method under test.
-        self.github_backup_instance.clone_or_update_repos(repos_mixed)
+        backup.clone_or_update_repos(["https://github.com/user/existing_repo.git"])
 
-        mock_makedirs.assert_called_once_with(self.test_backup_path, exist_ok=True)
-        # Assert that 'git pull' was called for the existing repository
-        mock_subprocess_run.assert_any_call(
-            ["git", "-C", os.path.join(self.test_backup_path, "existing_repo"), "pull"]
-        )
-        # Assert that 'git clone' was called for the new repository
-        mock_subprocess_run.assert_any_call(
-            ["git", "clone", "https://github.com/user/new_repo.git", os.path.join(self.test_backup_path, "new_repo")]
+        # Assert that no pull was run and the repository was reported as unchanged.
+        self.assertNotIn("pull", [arg for c in self.mock_popen.call_args_list for arg in c.args[0]])
+        self.assertIn("Unchanged existing_repo.\n", messages)
+
+    def test_clone_skipped_despite_unreachable_tag(self):
+        """
+        Tests that a clone whose branches match GitHub is not pulled because of a tag that no
+        branch reaches, which pull would never fetch.
+        """
+        self.mock_popen.side_effect = self.mock_git(lambda path: True, outputs={
+            # GitHub also has a tag on a commit of a deleted branch.
+            "ls-remote": "1111\trefs/heads/main\n3333\trefs/tags/old-side\n",
+            "for-each-ref": "* 1111 refs/heads/main refs/remotes/origin/main\n"
+                            "  1111 refs/remotes/origin/main \n",
+        })
+        self.mock_listing(["existing_repo"])
+        messages = []
+        backup = GithubBackup(self.test_backup_path, messages.append, popen=self.mock_popen)
+
+        # Call the method under test.
+        backup.clone_or_update_repos(["https://github.com/user/existing_repo.git"])
+
+        # Assert that no pull was run and the repository was reported as unchanged.
+        self.assertNotIn("pull", [arg for c in self.mock_popen.call_args_list for arg in c.args[0]])
+        self.assertIn("Unchanged existing_repo.\n", messages)
+
+    def test_no_shell_used(self):
+        """
+        Tests that no command goes through a shell, and that git is started in the way
+        that lets CPython use posix_spawn instead of fork and exec.
+        """
+        self.mock_popen.side_effect = self.mock_git(lambda path: "existing_repo" in path)
+        self.mock_listing(["existing_repo"])
+
+        # Call the method under test with a repository to update and one to clone.
+        self.github_backup_instance.clone_or_update_repos([
+            "https://github.com/user/existing_repo.git",
+            "https://github.com/user/new_repo.git",
+        ])
+
+        for c in self.mock_popen.call_args_list:
+            # Every command is an argument list, never a shell string.
+            self.assertIsInstance(c.args[0], list)
+            self.assertFalse(c.kwargs.get("shell", False))
+            if c.args[0][0] == "git":
+                # posix_spawn needs an absolute executable, inherited descriptors and no cwd or preexec_fn.
+                for key, value in POSIX_SPAWN.items():
+                    self.assertEqual(c.kwargs[key], value)
+                self.assertNotIn("cwd", c.kwargs)
+                self.assertNotIn("preexec_fn", c.kwargs)
+
+    def test_spawn_keywords_per_platform(self):
+        """
+        Tests that the posix_spawn keywords are only used on POSIX. On Windows Popen's defaults
+        must stay, or parallel git children inherit each other's pipe handles.
+        """
+        with patch("src.backup.os.name", "posix"):
+            self.github_backup_instance._spawn_git(["git", "--version"])
+        # Assert that POSIX skips the descriptor sweep and names git by its full path, as posix_spawn needs.
+        self.assertIs(self.mock_popen.call_args.kwargs["close_fds"], False)
+        self.assertIn("executable", self.mock_popen.call_args.kwargs)
+
+        with patch("src.backup.os.name", "nt"):
+            self.github_backup_instance._spawn_git(["git", "--version"])
+        # Assert that Windows leaves both to Popen, which closes the inherited handles.
+        self.assertNotIn("close_fds", self.mock_popen.call_args.kwargs)
+        self.assertNotIn("executable", self.mock_popen.call_args.kwargs)
+
+    def test_progress_only_moves_forward(self):
+        """
+        Tests that progress is reported only when the percentage changes,
+        even when many repositories finish within the same percent.
+        """
+        self.mock_popen.side_effect = self.mock_git(lambda path: False)
+        self.mock_listing([])
+        progress = []
+        backup = GithubBackup(self.test_backup_path, self.mock_log, progress.append, popen=self.mock_popen)
+
+        # Call the method under test with more repositories than percentage steps.
+        backup.clone_or_update_repos([f"https://github.com/user/repo{i}.git" for i in range(200)])
+
+        # Assert that every reported value is new and larger than the one before, ending at 100%.
+        self.assertEqual(progress, sorted(set(progress)))
+        self.assertEqual(len(progress), 91)
+        self.assertEqual(progress[-1], 100)
+
+    def test_repo_name_keeps_inner_dot_git(self):
+        """
+        Tests that only a trailing '.git' is stripped from the repository name,
+        so names such as 'user.github.io' keep their folder name.
+        """
+        self.mock_popen.side_effect = self.mock_git(lambda path: False)
+        self.mock_listing([])
+
+        # Call the method under test.
+        self.github_backup_instance.clone_or_update_repos(["https://github.com/user/user.github.io"])
+
+        # Assert that the clone target keeps the full repository name.
+        self.mock_popen.assert_any_call(
+            ["git", "clone", "https://github.com/user/user.github.io",
+             REPO_PATHS["user.github.io"]],
+            **GIT_OUTPUT,
         )
 
+    def test_git_output_is_decoded_as_utf8(self):
+        """
+        Tests that git's UTF-8 output, and any stray byte in it, reaches the log whatever
+        the locale codec is, instead of raising UnicodeDecodeError in a worker.
+        """
+        # Decode the raw output with the text settings the pipe was opened with, as Popen would,
+        # falling back to Windows' cp1252 locale codec when no encoding is given.
+        def popen(args, **kwargs):
+            raw = "Cloning into 'Ángel/репо'...\n".encode() + b"remote: \xff\n"
+            mock_proc = self.mock_process(0, b"")
+            mock_proc.stdout = io.TextIOWrapper(io.BytesIO(raw), encoding=kwargs.get("encoding") or "cp1252",
+                                                errors=kwargs.get("errors"))
+            return mock_proc
+
+        self.mock_popen.side_effect = popen
+        messages = []
+        backup = GithubBackup(self.test_backup_path, messages.append, popen=self.mock_popen)
+
+        # Call the method under test.
+        returncode = backup._run_git(["git", "clone", "url", "Ángel"], "Ángel")
+
+        # Assert that both lines were logged, the invalid byte as a replacement character.
+        self.assertEqual(returncode, 0)
+        self.assertEqual(messages, ["[Ángel] Cloning into 'Ángel/репо'...\n", "[Ángel] remote: \ufffd\n"])
+
+    def test_failed_clone_is_logged(self):
+        """
+        Tests that a failing git command is reported through the log callback
+        together with git's error output.
+        """
+        # Simulate git clone failing with an error message.
+        self.mock_popen.side_effect = self.mock_git(lambda path: False, returncode=128,
+                                                    output="fatal: repository not found\n")
+        self.mock_listing([])
+        messages = []
+        backup = GithubBackup(self.test_backup_path, messages.append, popen=self.mock_popen)
+
+        # Call the method under test.
+        backup.clone_or_update_repos(["https://github.com/user/missing_repo.git"])
+
+        # Assert that git's output was forwarded line by line, tagged with the repository, and the failure logged.
+        self.assertIn("[missing_repo] fatal: repository not found\n", messages)
+        self.assertIn("Failed to clone missing_repo.\n", messages)
+
+    def test_git_uses_gh_token(self):
+        """
+        Tests that the gh token is looked up on every backup and handed to git as a github.com
+        request header through the environment, not through the clone URL.
+        """
+        # gh is logged out for the first backup, then logged in, then its token is rotated.
+        tokens = iter([(1, ""), (0, "gho_secret\n"), (0, "gho_rotated\n")])
+
+        def popen(args, **kwargs):
+            if args == ["gh", "auth", "token"]:
+                return self.mock_process(*next(tokens))
+            return self.mock_process(0, "")
+
+        self.mock_popen.side_effect = popen
+        self.mock_listing([])
+
+        # Back up three times with the same instance.
+        backup = GithubBackup(self.test_backup_path, self.mock_log, popen=self.mock_popen)
+        for _ in range(3):
+            backup.clone_or_update_repos(["https://github.com/user/new_repo.git"])
+
+        # Assert that gh was asked for the token once per backup.
+        commands = [c.args[0] for c in self.mock_popen.call_args_list]
+        self.assertEqual(commands.count(["gh", "auth", "token"]), 3)
+        # Assert that the clone URL is unchanged and only the current token reaches git, as a Basic auth header.
+        clones = [c for c in self.mock_popen.call_args_list if c.args[0][:2] == ["git", "clone"]]
+        self.assertEqual({c.args[0][2] for c in clones}, {"https://github.com/user/new_repo.git"})
+        envs = [c.kwargs["env"] for c in clones]
+        self.assertNotIn("http.https://github.com/.extraHeader", envs[0].values())
+        for env, token in zip(envs[1:], [b"gho_secret", b"gho_rotated"]):
+            # One header entry on top of the base config, the previous backup's is not repeated.
+            count = int(env["GIT_CONFIG_COUNT"])
+            self.assertEqual(count, int(envs[0]["GIT_CONFIG_COUNT"]) + 1)
+            self.assertEqual(env[f"GIT_CONFIG_KEY_{count - 1}"], "http.https://github.com/.extraHeader")
+            self.assertEqual(env[f"GIT_CONFIG_VALUE_{count - 1}"],
+                             "Authorization: Basic " + base64.b64encode(b"x-access-token:" + token).decode())
+
+    @unittest.skipUnless(os.name == "posix", "SSH connection sharing is POSIX only")
+    @patch.dict(os.environ)
+    def test_ssh_remotes_share_connection(self):
+        """
+        Tests that SSH remotes are cloned through an ssh command that multiplexes
+        one connection across git processes.
+        """
+        os.environ.pop("GIT_SSH_COMMAND", None)
+        os.environ.pop("GIT_SSH", None)
+        self.mock_popen.side_effect = self.mock_git(lambda path: False)
+        self.mock_listing([])
+        backup = GithubBackup(self.test_backup_path, self.mock_log, popen=self.mock_popen)
+
+        # Call the method under test with an SSH URL.
+        backup.clone_or_update_repos(["git@github.com:user/new_repo.git"])
+
+        # Assert that the clone ran with ControlMaster connection sharing.
+        clone = next(c for c in self.mock_popen.call_args_list if c.args[0][:2] == ["git", "clone"])
+        ssh_command = clone.kwargs["env"]["GIT_SSH_COMMAND"]
+        self.assertIn("ControlMaster=auto", ssh_command)
+        # Assert that the sockets go to the user's private ~/.ssh, not the shared temp folder.
+        ssh_dir = os.path.join(os.path.expanduser("~"), ".ssh")
+        self.assertIn("ControlPath=" + os.path.join(ssh_dir, "github-backup-%C"), ssh_command)
+        self.mock_makedirs.assert_any_call(ssh_dir, mode=0o700, exist_ok=True)
+
+        # Without a private folder for the sockets, connections are not shared at all.
+        def makedirs(path, **kwargs):
+            if path == ssh_dir:
+                raise PermissionError(path)
+
+        self.mock_popen.reset_mock()
+        self.mock_makedirs.side_effect = makedirs
+        backup = GithubBackup(self.test_backup_path, self.mock_log, popen=self.mock_popen)
+        backup.clone_or_update_repos(["git@github.com:user/new_repo.git"])
+        clone = next(c for c in self.mock_popen.call_args_list if c.args[0][:2] == ["git", "clone"])
+        self.assertNotIn("GIT_SSH_COMMAND", clone.kwargs["env"])
+
+    @patch.dict(os.environ, {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "user.name",
+                             "GIT_CONFIG_VALUE_0": "Test"})
+    def test_git_config_env(self):
+        """
+        Tests that git runs with protocol v2 and parallel fetches enabled through the environment,
+        without overwriting configuration the user already passes the same way.
+        """
+        env = GithubBackup(self.test_backup_path, self.mock_log)._env
+
+        # Assert that the existing entry is kept and the new ones are appended after it.
+        self.assertEqual(env["GIT_CONFIG_COUNT"], "3")
+        self.assertEqual((env["GIT_CONFIG_KEY_0"], env["GIT_CONFIG_VALUE_0"]), ("user.name", "Test"))
+        self.assertEqual((env["GIT_CONFIG_KEY_1"], env["GIT_CONFIG_VALUE_1"]), ("protocol.version", "2"))
+        self.assertEqual((env["GIT_CONFIG_KEY_2"], env["GIT_CONFIG_VALUE_2"]), ("fetch.parallel", "0"))
+
     def test_set_get_path(self):
         """
         Tests the setter and getter methods for the backup path.
@@ -233,7 +779,3 @@ class TestGithubBackup(unittest.TestCase):
         self.github_backup_instance.set_path(new_path)
         # Assert that the new path is correctly retrieved.
         self.assertEqual(self.github_backup_instance.get_path(), new_path)
-
-
-if __name__ == "__main__":
-    unittest.main()